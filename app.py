@@ -1,9 +1,13 @@
 import os
 import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, render_template, request, redirect, url_for, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from itertools import combinations
-from logic import GroupOptimizer
+from logic import OPTIMIZE_MODES, PairConstraints, optimize_cohort, parse_attendance, parse_participants, validate_time_budget
 
 app = Flask(__name__)
 
@@ -78,71 +82,20 @@ def index():
     if request.method == 'POST':
         raw_text = request.form.get('participants')
         
-        # 入力テキストを解析して辞書リストを作る
-        # 入力形式: 名前,学年,性別,工具,出欠(1;1;0;1)
-        participants = []
-        for line in raw_text.splitlines():
-            line = line.strip()
-            if not line: continue
-            
-            parts = [p.strip() for p in line.split(',')]
-            
-            if not parts: continue
-            
-            name = parts[0]
-            grade = parts[1] if len(parts) > 1 else "?"
-            gender = parts[2] if len(parts) > 2 else "?"
-            
-            # 第4要素: 工具係判定
-            is_tool = False
-            if len(parts) > 3:
-                is_tool = parts[3].upper() in ['TOOL', '工具', 'TRUE', 'YES', '1']
-
-            # 第5要素: 出欠データ (例: "1;1;0;1")
-            attendance = []
-            if len(parts) > 4:
-                attendance = [x == '1' for x in parts[4].split(';')]
-
-            participants.append({
-                'name': name,
-                'grade': grade,
-                'gender': gender,
-                'is_tool': is_tool,
-                'attendance': attendance
-            })
-
         try:
             num_groups = int(request.form.get('num_groups'))
             num_days = int(request.form.get('num_days'))
         except ValueError:
             return "数字を正しく入力してください", 400
 
-        # 出欠データが未設定の場合は全日参加扱い
-        for p in participants:
-            if not p['attendance']:
-                p['attendance'] = [True] * num_days
-            # 日数に合わせて調整
-            while len(p['attendance']) < num_days:
-                p['attendance'].append(True)
+        # 入力テキストを解析して辞書リストを作る（出欠は日数に合わせて補完）
+        participants = parse_participants(raw_text, num_days)
 
         existing_history = load_history_from_db()
 
-        # オプティマイザーに辞書リストを渡す（出欠情報付き）
-        optimizer = GroupOptimizer(participants)
-        
-        # 履歴データの復元
-        for pair, count in existing_history.items():
-            optimizer.pair_history[pair] = count
-
-        # カップルペアの偽装履歴を注入（同じグループを回避するため）
+        # カップルペア（同じグループを回避する）
         couples_json = request.form.get('couples', '[]')
         couples = json.loads(couples_json)
-        for couple in couples:
-            name1 = couple.get('name1', '')
-            name2 = couple.get('name2', '')
-            if name1 and name2:
-                pair_key = optimizer._get_pair_key(name1, name2)
-                optimizer.pair_history[pair_key] += 3  # 大きな偽装値で回避
 
         # 手動日程（確定済み）を受け取り、残りを自動最適化
         manual_days_json = request.form.get('manual_days', '[]')
@@ -156,7 +109,9 @@ def index():
                 'groups': md['groups']
             })
         
-        schedule = optimizer.make_groups(num_groups, num_days, fixed_days=fixed_days)
+        # オプティマイザーに辞書リストを渡す（出欠情報・履歴・カップル付き）
+        schedule = optimize_cohort(participants, num_groups, num_days,
+                                   history=existing_history, couples=couples, fixed_days=fixed_days)
         message = f"グループ分けしました！"
         # 手動保存のためのデータを準備
         schedule_json = json.dumps(schedule, ensure_ascii=False)
@@ -174,18 +129,26 @@ def index():
 
 
 def save_groups_to_db_fixed(schedule):
-    for day in schedule:
-        for group in day['groups']:
-            # groupの中身が [{'name':..., 'grade':..., 'gender':...}, ...] となっている
-            clean_names = [p['name'] for p in group]
-            
-            for p1, p2 in combinations(clean_names, 2):
-                sorted_p1, sorted_p2 = sorted((p1, p2))
-                record = PairHistory.query.filter_by(person1=sorted_p1, person2=sorted_p2).first()
-                if record:
-                    record.count += 1
-                else:
-                    db.session.add(new_record := PairHistory(person1=sorted_p1, person2=sorted_p2, count=1))
+    save_schedules_to_db([schedule])
+
+def save_schedules_to_db(schedules):
+    """複数スケジュールのペアをまとめて集計し、1トランザクションでDBに加算する"""
+    # 同じペアが何度出てきても1回の検索で済むように先に数えておく
+    increments = Counter()
+    for schedule in schedules:
+        for day in schedule:
+            for group in day['groups']:
+                # groupの中身が [{'name':..., 'grade':..., 'gender':...}, ...] となっている
+                clean_names = [p['name'] for p in group]
+                for p1, p2 in combinations(clean_names, 2):
+                    increments[get_sorted_pair(p1, p2)] += 1
+
+    for (sorted_p1, sorted_p2), n in increments.items():
+        record = PairHistory.query.filter_by(person1=sorted_p1, person2=sorted_p2).first()
+        if record:
+            record.count += n
+        else:
+            db.session.add(PairHistory(person1=sorted_p1, person2=sorted_p2, count=n))
     db.session.commit()
 
 # --- 履歴リセット機能（おまけ） ---
@@ -307,6 +270,159 @@ def api_members_reset():
     db.session.commit()
     return jsonify({'status': 'ok'})
 
+# --- 複数コホート一括最適化API ---
+# 最適化はCPUバウンドなのでスレッドではなくプロセスで並列化する（初回利用時に起動）
+_cohort_pool = None
+
+# 1コホートの結果を待つ秒数（time_budget があればその秒数を足す）
+# これを過ぎたコホートはエラーにして、止まらないワーカーごとプールを作り直す
+COHORT_TIMEOUT = 300
+
+def get_cohort_pool():
+    global _cohort_pool
+    if _cohort_pool is None:
+        _cohort_pool = ProcessPoolExecutor()
+    return _cohort_pool
+
+def reset_cohort_pool():
+    """壊れた・止まらないワーカーがいるプールを捨てる（次のリクエストで作り直す）"""
+    global _cohort_pool
+    if _cohort_pool is not None:
+        # shutdown だけでは実行中のワーカーは止まらないので、残っているプロセスは終了させる
+        processes = list((_cohort_pool._processes or {}).values())
+        _cohort_pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+    _cohort_pool = None
+
+def parse_cohort_spec(spec):
+    """
+    コホート指定を optimize_cohort の引数に変換する
+    participants はフォームと同じテキスト形式、または辞書のリスト
+    """
+    try:
+        num_groups = int(spec['num_groups'])
+        num_days = int(spec['num_days'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('num_groups と num_days を数字で指定してください')
+    if num_groups < 1 or num_days < 1:
+        raise ValueError('num_groups と num_days は1以上にしてください')
+
+    raw = spec.get('participants', [])
+    if isinstance(raw, str):
+        participants = parse_participants(raw, num_days)
+    else:
+        participants = []
+        for p in raw:
+            name = p.get('name')
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError('参加者の name を文字列で指定してください')
+            # 出欠はテキスト形式と同じく '1' / 1 / true だけを参加扱いにする（不足分は参加扱い）
+            attendance = parse_attendance(p.get('attendance'), num_days)
+            participants.append({
+                'name': name.strip(),
+                'grade': p.get('grade', '?'),
+                'gender': p.get('gender', '?'),
+                'is_tool': bool(p.get('is_tool', False)),
+                'attendance': attendance
+            })
+    if not participants:
+        raise ValueError('参加者がいません')
+
+    mode = spec.get('mode', 'sequential')
+    if mode not in OPTIMIZE_MODES:
+        raise ValueError(f"mode は {' / '.join(OPTIMIZE_MODES)} のどれかにしてください")
+    time_budget = validate_time_budget(spec.get('time_budget'))
+
+    # ペア制約・カップルはワーカーに渡す前にここで検証しておく
+    pair_rules = spec.get('pair_rules', [])
+    PairConstraints.from_rules(pair_rules)
+    couples = spec.get('couples', [])
+    PairConstraints.from_rules([{
+        'type': PairConstraints.MUST_SEPARATE,
+        'name1': c.get('name1', ''),
+        'name2': c.get('name2', '')
+    } for c in couples])
+
+    fixed_days = [{'day': md['day'], 'groups': md['groups']} for md in spec.get('manual_days', [])]
+    return {
+        'participants': participants,
+        'num_groups': num_groups,
+        'num_days': num_days,
+        'couples': couples,
+        'pair_rules': pair_rules,
+        'fixed_days': fixed_days,
+        'mode': mode,
+        'time_budget': time_budget,
+    }
+
+@app.route('/api/batch_optimize', methods=['POST'])
+def api_batch_optimize():
+    """
+    複数コホートをまとめてグループ分けする
+    入力: {'cohorts': [{'name', 'participants', 'num_groups', 'num_days', 'couples', 'pair_rules', 'manual_days',
+                        'mode', 'time_budget'}, ...],
+           'save': true/false}
+    履歴はDBから1回だけ読み込み、各コホートはワーカープロセスで並列に最適化する
+    失敗したコホート（COHORT_TIMEOUT 秒を過ぎたものを含む）は 'error' を返す（1つでも失敗したら保存はしない）
+    """
+    data = request.get_json(silent=True) or {}
+    specs = data.get('cohorts')
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': 'cohorts が必要です'}), 400
+
+    cohorts = []
+    for i, spec in enumerate(specs):
+        try:
+            cohorts.append(parse_cohort_spec(spec))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'コホート{i + 1}: {e}'}), 400
+
+    existing_history = load_history_from_db()
+
+    start = time.perf_counter()
+    try:
+        pool = get_cohort_pool()
+        futures = [pool.submit(optimize_cohort, history=existing_history, **c) for c in cohorts]
+    except BrokenProcessPool:
+        reset_cohort_pool()
+        return jsonify({'error': 'ワーカープロセスが停止しました。もう一度実行してください'}), 500
+
+    results = []
+    broken = False
+    for i, (spec, cohort, future) in enumerate(zip(specs, cohorts, futures)):
+        result = {'name': spec.get('name', f'コホート{i + 1}')}
+        timeout = COHORT_TIMEOUT + (cohort['time_budget'] or 0)
+        try:
+            result['schedule'] = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            broken = True
+            result['error'] = f'最適化が {timeout:g} 秒以内に終わりませんでした'
+        except BrokenProcessPool:
+            broken = True
+            result['error'] = 'ワーカープロセスが停止しました'
+        except Exception as e:
+            result['error'] = f'最適化中にエラーが発生しました: {e}'
+        results.append(result)
+    if broken:
+        reset_cohort_pool()
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if 'error' in r]
+    saved = bool(data.get('save')) and not failed
+    if saved:
+        save_schedules_to_db([r['schedule'] for r in results])
+
+    body = {
+        'cohorts': results,
+        'saved': saved,
+        'elapsed': round(elapsed, 3)
+    }
+    if len(failed) == len(results):
+        body['error'] = '全てのコホートで最適化に失敗しました'
+        return jsonify(body), 500
+    return jsonify(body)
+
 if __name__ == '__main__':
     app.run(debug=True)
     
@@ -0,0 +1,274 @@
+"""
+コマンドラインからグループ分けを実行するためのエントリポイント
+（Webサーバーを使わずに、実際の名簿で重みなどをオフラインで調整するため）
+
+使い方:
+    # 1回だけグループ分けしてJSONを出力
+    python cli.py run roster.txt --history history.json --groups 6 --days 5
+
+    # 重み・試行回数・ステップ数・最適化方式のグリッドを並列実行して結果表を出力
+    python cli.py sweep roster.txt --history history.json --groups 6 --days 5 \
+        --grid history=5000,10000 --grid attempts=5,10 --grid steps=1000,2000 \
+        --grid mode=sequential,joint --output sweep.csv
+
+roster.txt はフォームと同じ形式（名前,学年,性別,工具,出欠(1;1;0;1)）
+history.json は /api/history の出力をそのまま保存したもの（CSV: person1,person2,count も可）
+rules.json はペア制約のリスト（例: [{"type": "must_separate", "name1": "A", "name2": "B"}]）
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from logic import (DEFAULT_WEIGHTS, MAX_TIME_BUDGET, OPTIMIZE_MODES, PairConstraints, optimize_cohort,
+                   parse_participants, validate_time_budget)
+
+# グリッドで指定できる重み以外のパラメータ
+RUN_PARAMS = ('mode', 'attempts', 'steps')
+
+# 結果表に出すスコア内訳
+DETAIL_KEYS = ('history', 'pair', 'separate_violations', 'gender', 'grade', 'tool', 'total', 'duplicate_count')
+
+
+def load_roster(path, num_days):
+    """名簿ファイルを読み込んで参加者の辞書リストにする"""
+    with open(path, encoding='utf-8') as f:
+        return parse_participants(f.read(), num_days)
+
+
+def load_history(path):
+    """
+    履歴エクスポートを読み込んで {(名前1, 名前2): 回数} の辞書にする
+    .json: /api/history の出力（{'pairs': [{'person1', 'person2', 'count'}, ...]}）
+    .csv : person1,person2,count の行（ヘッダー行は任意）
+    """
+    history = {}
+    if path is None:
+        return history
+
+    if path.lower().endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].strip() == 'person1':
+                    continue
+                p1, p2 = sorted((row[0].strip(), row[1].strip()))
+                history[(p1, p2)] = int(row[2])
+        return history
+
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    for r in data.get('pairs', []):
+        p1, p2 = sorted((r['person1'], r['person2']))
+        history[(p1, p2)] = r['count']
+    return history
+
+
+def load_rules(path):
+    """
+    ペア制約ファイル（PairConstraints.from_rules に渡すJSONのリスト）を読み込む
+    スイープの各ワーカーで同じエラーになる前に、ここで検証して ValueError にする
+    """
+    if path is None:
+        return []
+    with open(path, encoding='utf-8') as f:
+        try:
+            rules = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"ペア制約ファイルのJSONが不正です: {path}（{e}）")
+    if not isinstance(rules, list):
+        raise ValueError(f"ペア制約ファイルはルールのリストにしてください: {path}")
+    try:
+        PairConstraints.from_rules(rules)
+    except AttributeError:
+        raise ValueError(f"ペア制約ファイルの各ルールは辞書にしてください: {path}")
+    return rules
+
+
+def run_schedule(participants, history, num_groups, num_days, pair_rules=None,
+                 weights=None, attempts=10, steps=2000, mode='sequential', time_budget=None, seed=None):
+    """
+    1回分のグループ分けを実行し、(スケジュール, 実行秒数) を返す
+    """
+    if seed is not None:
+        random.seed(seed)
+
+    start = time.perf_counter()
+    schedule = optimize_cohort(participants, num_groups, num_days, history=history, pair_rules=pair_rules,
+                               weights=weights, attempts=attempts, optimize_steps=steps,
+                               mode=mode, time_budget=time_budget)
+    elapsed = time.perf_counter() - start
+    return schedule, elapsed
+
+
+def summarize(schedule):
+    """全日程のスコア内訳を合計する"""
+    totals = dict.fromkeys(DETAIL_KEYS, 0)
+    for day in schedule:
+        for key in DETAIL_KEYS:
+            totals[key] += day['details'].get(key, 0)
+    return totals
+
+
+def _sweep_worker(task):
+    """プロセスプールで実行される1設定分の処理（pickle可能なようにモジュール直下に置く）"""
+    settings, participants, history, pair_rules, num_groups, num_days, time_budget, seed = task
+    weights = {k: v for k, v in settings.items() if k in DEFAULT_WEIGHTS}
+    schedule, elapsed = run_schedule(
+        participants, history, num_groups, num_days,
+        pair_rules=pair_rules,
+        weights=weights,
+        attempts=settings['attempts'],
+        steps=settings['steps'],
+        mode=settings['mode'],
+        time_budget=time_budget,
+        seed=seed,
+    )
+    # 重みの列はスコア内訳の列と名前が被るので 'w_' を付ける
+    row = {(f'w_{k}' if k in DEFAULT_WEIGHTS else k): v for k, v in settings.items()}
+    row['seed'] = seed
+    row.update(summarize(schedule))
+    row['seconds'] = round(elapsed, 3)
+    return row
+
+
+def parse_grid(specs, attempts, steps, mode):
+    """
+    '--grid key=v1,v2' の指定を全組み合わせの設定リストに展開する
+    指定されなかったキーはデフォルト値（1通り）を使う
+    """
+    axes = {k: [v] for k, v in DEFAULT_WEIGHTS.items()}
+    axes['mode'] = [mode]
+    axes['attempts'] = [attempts]
+    axes['steps'] = [steps]
+
+    for spec in specs or []:
+        key, sep, values = spec.partition('=')
+        key = key.strip()
+        if not sep or key not in axes:
+            valid = ', '.join(list(DEFAULT_WEIGHTS) + list(RUN_PARAMS))
+            raise ValueError(f"--grid の指定が不正です: {spec}（使用可能: {valid}）")
+        if key == 'mode':
+            axes[key] = [v.strip() for v in values.split(',') if v.strip()]
+            unknown = set(axes[key]) - set(OPTIMIZE_MODES)
+            if unknown:
+                raise ValueError(f"--grid の mode が不正です: {', '.join(sorted(unknown))}（使用可能: {', '.join(OPTIMIZE_MODES)}）")
+        else:
+            axes[key] = [int(v) for v in values.split(',') if v.strip()]
+            if key == 'attempts' and min(axes[key], default=1) < 1:
+                raise ValueError(f"--grid の attempts は1以上にしてください: {spec}")
+
+    keys = list(axes)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(axes[k] for k in keys))]
+
+
+def positive_int(value):
+    """--groups / --days などの型チェック（1以上の整数）"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"整数で指定してください: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1以上にしてください: {value}")
+    return number
+
+
+def time_budget_arg(value):
+    """--time-budget の型チェック（NaN / Infinity・0以下・上限超えは引数エラーにする）"""
+    try:
+        return validate_time_budget(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def cmd_run(args):
+    participants = load_roster(args.roster, args.days)
+    history = load_history(args.history)
+    try:
+        pair_rules = load_rules(args.rules)
+    except ValueError as e:
+        sys.exit(str(e))
+    schedule, elapsed = run_schedule(
+        participants, history, args.groups, args.days, pair_rules=pair_rules,
+        attempts=args.attempts, steps=args.steps,
+        mode=args.mode, time_budget=args.time_budget, seed=args.seed,
+    )
+    json.dump(schedule, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write('\n')
+    print(f"{elapsed:.3f} 秒", file=sys.stderr)
+
+
+def cmd_sweep(args):
+    participants = load_roster(args.roster, args.days)
+    history = load_history(args.history)
+    try:
+        pair_rules = load_rules(args.rules)
+        grid = parse_grid(args.grid, args.attempts, args.steps, args.mode)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    seeds = [args.seed + i if args.seed is not None else None for i in range(args.repeats)]
+    tasks = [
+        (settings, participants, history, pair_rules, args.groups, args.days, args.time_budget, seed)
+        for settings in grid
+        for seed in seeds
+    ]
+    print(f"{len(tasks)} 通りを実行します（workers={args.workers or os.cpu_count()}）", file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        rows = list(pool.map(_sweep_worker, tasks))
+
+    fieldnames = [f'w_{k}' for k in DEFAULT_WEIGHTS] + list(RUN_PARAMS) + ['seed'] + list(DETAIL_KEYS) + ['seconds']
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='グループ分けをコマンドラインから実行する')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('roster', help='名簿ファイル（名前,学年,性別,工具,出欠）')
+    common.add_argument('--history', help='履歴エクスポート（/api/history のJSON または CSV）')
+    common.add_argument('--rules', help='ペア制約ファイル（avoid / prefer / must_separate / must_together のJSON）')
+    common.add_argument('--groups', type=positive_int, required=True, help='グループ数')
+    common.add_argument('--days', type=positive_int, required=True, help='日数')
+    common.add_argument('--attempts', type=positive_int, default=10, help='ランダム初期化の回数')
+    common.add_argument('--steps', type=int, default=2000, help='1回の生成あたりの入れ替え回数')
+    common.add_argument('--mode', choices=OPTIMIZE_MODES, default='sequential',
+                        help='sequential: 1日ずつ確定 / joint: 全日程をまとめて最適化')
+    common.add_argument('--time-budget', type=time_budget_arg, default=None,
+                        help=f'joint モードの探索に使う秒数（使い切るまで探索する。最大 {MAX_TIME_BUDGET} 秒）')
+    common.add_argument('--seed', type=int, default=None, help='乱数シード（再現用）')
+
+    p_run = sub.add_parser('run', parents=[common], help='1回だけグループ分けしてJSONを出力')
+    p_run.set_defaults(func=cmd_run)
+
+    p_sweep = sub.add_parser('sweep', parents=[common], help='設定のグリッドを並列実行して結果表を出力')
+    p_sweep.add_argument('--grid', action='append', metavar='KEY=V1,V2',
+                         help='振る値（重み: %s / mode / attempts / steps）' % ', '.join(DEFAULT_WEIGHTS))
+    p_sweep.add_argument('--repeats', type=positive_int, default=1, help='各設定の繰り返し回数')
+    p_sweep.add_argument('--workers', type=positive_int, default=None, help='プロセス数（省略時はCPU数）')
+    p_sweep.add_argument('--output', help='結果CSVの出力先（省略時は標準出力）')
+    p_sweep.set_defaults(func=cmd_sweep)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
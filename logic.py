@@ -1,30 +1,205 @@
+import math
 import random
 import itertools
-import copy
+import time
 from collections import defaultdict
 
+
+# make_groups の最適化方式
+# sequential: 1日ずつ確定して履歴に積む / joint: 全日程をまとめて入れ替え探索する
+OPTIMIZE_MODES = ('sequential', 'joint')
+
+# joint モードで「重複ペアを抱えている人」を探す回数（見つからなければランダムな人を動かす）
+CONFLICT_TRIES = 4
+
+# joint モードの1手（同じ日の全員との入れ替えを比べる）が、1日ずつの方式の入れ替え何回分の計算に当たるか
+# time_budget が無いときはこの比で手数を決める（時間で打ち切ると乱数シードで再現できないため）
+JOINT_MOVE_STEPS = 25
+
+# time_budget に指定できる上限の秒数（APIやCLIから極端な値で探索が終わらなくなるのを防ぐ）
+MAX_TIME_BUDGET = 600
+
+# must_separate を守れない初期解（貪欲な配置の行き詰まり）で残った違反へのペナルティ
+# 入れ替えで新しい違反は作らないので、実際に効くのはこのフォールバックの時だけ
+SEPARATE_VIOLATION_PENALTY = 1000000
+
+# 初期解で must_separate の違反が残ったときに、並べ直して配置をやり直す回数
+INITIAL_RETRIES = 20
+
+# 重みのデフォルト値（CLIのスイープなどから上書き可能）
+DEFAULT_WEIGHTS = {
+    # 過去の重複は絶対に避けたいので超特大ペナルティ
+    'history': 10000,
+    # 女性1人はかわいそうなので大きめのペナルティ
+    'sole_female': 500,
+    # 学年被りは、まぁ仕方ないこともあるので小さめ
+    'same_grade': 50,
+    # 工具係の配分コスト
+    # 1. 人数が十分なのに0人のグループがある場合（強め）
+    'tool_shortage': 2000,
+    # 2. 人数が足りないのに2人以上固まった場合（絶対避ける）
+    'tool_overcrowd': 10000,
+    # ペア制約（avoid / prefer）で個別の重みが無いときの値
+    'avoid': 10000,
+    'prefer': 1000,
+}
+
+
+def parse_attendance(values, num_days):
+    """
+    出欠データを日ごとの True / False のリストにする
+    values: "1;1;0;1" 形式の文字列、または値のリスト（'1' / 1 / True が参加、それ以外は欠席）
+    未設定・不足の場合は参加扱いで num_days 日分に揃える
+    """
+    if values is None:
+        values = []
+    elif isinstance(values, str):
+        values = values.split(';')
+    attendance = [x is True or str(x).strip() == '1' for x in values]
+    while len(attendance) < num_days:
+        attendance.append(True)
+    return attendance
+
+
+def parse_participants(raw_text, num_days):
+    """
+    参加者テキストを解析して辞書リストを作る
+    入力形式: 名前,学年,性別,工具,出欠(1;1;0;1)
+    出欠データが未設定・不足の場合は参加扱いで num_days 日分に揃える
+    """
+    participants = []
+    for line in raw_text.splitlines():
+        line = line.strip()
+        if not line: continue
+
+        parts = [p.strip() for p in line.split(',')]
+
+        if not parts: continue
+
+        name = parts[0]
+        grade = parts[1] if len(parts) > 1 else "?"
+        gender = parts[2] if len(parts) > 2 else "?"
+
+        # 第4要素: 工具係判定
+        is_tool = False
+        if len(parts) > 3:
+            is_tool = parts[3].upper() in ['TOOL', '工具', 'TRUE', 'YES', '1']
+
+        # 第5要素: 出欠データ (例: "1;1;0;1")
+        attendance = parse_attendance(parts[4] if len(parts) > 4 else None, num_days)
+
+        participants.append({
+            'name': name,
+            'grade': grade,
+            'gender': gender,
+            'is_tool': is_tool,
+            'attendance': attendance
+        })
+    return participants
+
+
+def validate_time_budget(time_budget):
+    """
+    time_budget の入力値を秒数（float）に変換する
+    None はそのまま返し、数値でないもの・NaN / Infinity・0以下・上限超えは ValueError
+    """
+    if time_budget is None:
+        return None
+    try:
+        time_budget = float(time_budget)
+    except (TypeError, ValueError):
+        raise ValueError(f"time_budget は秒数で指定してください: {time_budget}")
+    if not math.isfinite(time_budget) or not 0 < time_budget <= MAX_TIME_BUDGET:
+        raise ValueError(f"time_budget は 0 より大きく {MAX_TIME_BUDGET} 以下の秒数にしてください: {time_budget}")
+    return time_budget
+
+
+class PairConstraints:
+    """
+    ペア単位の制約ルール
+    avoid / prefer は重み付きのソフト制約（コストに加算・減算）
+    must_separate / must_together はハード制約（入れ替えの候補生成で守る）
+    """
+    AVOID = 'avoid'
+    PREFER = 'prefer'
+    MUST_SEPARATE = 'must_separate'
+    MUST_TOGETHER = 'must_together'
+    KINDS = (AVOID, PREFER, MUST_SEPARATE, MUST_TOGETHER)
+
+    def __init__(self):
+        # ソフト制約: キーは (名前1, 名前2)、値は (種類, 個別の重み or None)
+        self.soft = {}
+        self.separate = set()
+        self.together = set()
+
+    @classmethod
+    def from_rules(cls, rules):
+        """
+        rules: 辞書のリスト
+        例: [{'type': 'avoid', 'name1': 'Aさん', 'name2': 'Bさん', 'weight': 5000}, ...]
+        """
+        constraints = cls()
+        for rule in rules:
+            constraints.add(rule.get('type'), rule.get('name1', ''), rule.get('name2', ''), rule.get('weight'))
+        return constraints
+
+    def add(self, kind, name1, name2, weight=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"未知のペア制約: {kind}")
+        if not name1 or not name2 or name1 == name2:
+            raise ValueError(f"ペア制約には異なる2人の名前が必要です: {name1}, {name2}")
+        # bool は int の仲間だが重みとしては意味がないので弾く
+        if weight is not None and (isinstance(weight, bool) or not isinstance(weight, (int, float))
+                                   or not math.isfinite(weight)):
+            raise ValueError(f"ペア制約の重みは数値で指定してください: {weight}")
+        pair = tuple(sorted((name1, name2)))
+        if kind == self.MUST_SEPARATE:
+            self.separate.add(pair)
+        elif kind == self.MUST_TOGETHER:
+            self.together.add(pair)
+        else:
+            # 同じペアに avoid と prefer の両方があるのは矛盾なのでエラー（同じ種類の重複は後の重みで上書き）
+            existing = self.soft.get(pair)
+            if existing is not None and existing[0] != kind:
+                raise ValueError(f"同じペアに avoid と prefer の両方が指定されています: {name1}, {name2}")
+            self.soft[pair] = (kind, weight)
+
+    def soft_penalty(self, pair, weights):
+        """ソフト制約によるコスト（prefer は負の値）"""
+        rule = self.soft.get(pair)
+        if rule is None:
+            return 0
+        kind, weight = rule
+        if weight is None:
+            weight = weights[kind]
+        return -weight if kind == self.PREFER else weight
+
 class GroupOptimizer:
-    def __init__(self, participants):
+    def __init__(self, participants, weights=None, constraints=None):
         """
         participants: 辞書のリスト
         例: [{'name': 'Aさん', 'grade': '1', 'gender': 'F'}, ...]
+        weights: DEFAULT_WEIGHTS のキーで一部だけ上書きする辞書（省略時はデフォルト）
+        constraints: PairConstraints（省略時は制約なし）
         """
         self.participants = participants
         # 履歴辞書: キーは (名前1, 名前2)
         self.pair_history = defaultdict(int)
+        self.constraints = constraints or PairConstraints()
 
-        # --- 重み設定（ここを調整） ---
-        # 過去の重複は絶対に避けたいので超特大ペナルティ
-        self.WEIGHT_HISTORY = 10000    
-        # 女性1人はかわいそうなので大きめのペナルティ
-        self.WEIGHT_SOLE_FEMALE = 500  
-        # 学年被りは、まぁ仕方ないこともあるので小さめ
-        self.WEIGHT_SAME_GRADE = 50
-        # 工具係の配分コスト
-        # 1. 人数が十分なのに0人のグループがある場合（強め）
-        self.WEIGHT_TOOL_SHORTAGE = 2000 
-        # 2. 人数が足りないのに2人以上固まった場合（絶対避ける）
-        self.WEIGHT_TOOL_OVERCROWD = 10000    
+        # --- 重み設定（DEFAULT_WEIGHTS を調整） ---
+        w = dict(DEFAULT_WEIGHTS)
+        if weights:
+            unknown = set(weights) - set(DEFAULT_WEIGHTS)
+            if unknown:
+                raise ValueError(f"未知の重み: {', '.join(sorted(unknown))}")
+            w.update(weights)
+        self.WEIGHT_HISTORY = w['history']
+        self.WEIGHT_SOLE_FEMALE = w['sole_female']
+        self.WEIGHT_SAME_GRADE = w['same_grade']
+        self.WEIGHT_TOOL_SHORTAGE = w['tool_shortage']
+        self.WEIGHT_TOOL_OVERCROWD = w['tool_overcrowd']
+        self.weights = w
 
     def _get_pair_key(self, p1_name, p2_name):
         return tuple(sorted((p1_name, p2_name)))
@@ -58,6 +233,10 @@ class GroupOptimizer:
                 if hist_count > 0:
                     # 2回目なら10000点、3回目なら40000点...と激増させる
                     total_cost += (hist_count ** 2) * self.WEIGHT_HISTORY
+                # ペア制約（avoid / prefer、守れなかった must_separate）
+                total_cost += self.constraints.soft_penalty(pair_key, self.weights)
+                if pair_key in self.constraints.separate:
+                    total_cost += SEPARATE_VIOLATION_PENALTY
 
             # --- 2. 女性1人ぼっちチェック ---
             # '女', 'F', 'woman' などが含まれるか
@@ -89,6 +268,8 @@ class GroupOptimizer:
         """
         details = {
             'history': 0,
+            'pair': 0,
+            'separate_violations': 0,
             'gender': 0,
             'grade': 0,
             'tool': 0,
@@ -115,6 +296,13 @@ class GroupOptimizer:
                     cost = (hist_count ** 2) * self.WEIGHT_HISTORY
                     details['history'] += cost
                     details['total'] += cost
+                cost = self.constraints.soft_penalty(pair_key, self.weights)
+                # must_separate を守れなかったペア（割り当て不可能な場合など）は件数も返す
+                if pair_key in self.constraints.separate:
+                    cost += SEPARATE_VIOLATION_PENALTY
+                    details['separate_violations'] += 1
+                details['pair'] += cost
+                details['total'] += cost
 
             # 2. 性別
             female_count = sum(1 for g in genders if str(g).upper() in ['女', 'F', 'FEMALE', 'WOMAN'])
@@ -152,16 +340,21 @@ class GroupOptimizer:
                 pair = self._get_pair_key(p1, p2)
                 self.pair_history[pair] += 1
 
-    def make_groups(self, num_groups, num_days, attempts=10, fixed_days=None):
+    def make_groups(self, num_groups, num_days, attempts=10, fixed_days=None, optimize_steps=2000,
+                    mode='sequential', time_budget=None):
         """
         attempts: ここでは「ランダム初期化の回数」
-        optimize_steps: その後の「交換改善」の回数
+        optimize_steps: その後の「交換改善」の回数（1回の生成につき何回「入れ替え」を試すか）
         fixed_days: 手動で確定した日程のリスト（ハイブリッドモード用）
                     例: [{'day': 1, 'groups': [[{name, grade, gender, is_tool}, ...], ...]}]
                     None の場合は全自動モード
+        mode: 'sequential' は1日ずつ確定していく方式、'joint' は全日程をまとめて最適化する方式
+        time_budget: 'joint' の探索に使う秒数（使い切るまで探索する。None なら1日ずつの方式と同程度の手数で打ち切る）
         """
+        if mode not in OPTIMIZE_MODES:
+            raise ValueError(f"未知のモード: {mode}")
+
         schedule = [] 
-        optimize_steps = 2000 # 1回の生成につき何回「入れ替え」を試すか
 
         # 今回のセッション内での履歴（過去のDB履歴は含まない）
         session_pair_history = defaultdict(int)
@@ -209,6 +402,8 @@ class GroupOptimizer:
                     "is_manual": True
                 })
 
+        # 自動で最適化する日: (日, 参加者, グループ数)
+        auto_days = []
         for day in range(1, num_days + 1):
             # ハイブリッドモード: 手動確定した日はスキップ
             if day in fixed_day_numbers:
@@ -229,118 +424,581 @@ class GroupOptimizer:
                     "day": day,
                     "groups": [],
                     "cost": 0,
-                    "details": {'history': 0, 'gender': 0, 'grade': 0, 'tool': 0, 'total': 0, 'duplicate_count': 0, 'absent_count': len(self.participants)},
+                    "details": {'history': 0, 'pair': 0, 'separate_violations': 0, 'gender': 0, 'grade': 0, 'tool': 0, 'total': 0, 'duplicate_count': 0, 'absent_count': len(self.participants)},
                 })
                 continue
 
             # グループ数を参加者数以下に制限
             effective_groups = min(num_groups, len(day_participants))
+            auto_days.append((day, day_participants, effective_groups))
 
-            best_groups = None
-            min_cost = float('inf')
-
-            # --- 1. 多点スタート（局所解回避のため数回最初からやり直す） ---
-            for _ in range(attempts):
-                # A. ランダム初期解の生成
-                shuffled = day_participants[:]
-                random.shuffle(shuffled)
-                
-                current_groups = []
-                k, m = divmod(len(shuffled), effective_groups)
-                start_idx = 0
-                for i in range(effective_groups):
-                    group_size = k + 1 if i < m else k
-                    current_groups.append(shuffled[start_idx : start_idx + group_size])
-                    start_idx += group_size
-
-                current_cost = self._calculate_cost(current_groups)
-
-                # B. 山登り法（改善ループ）
-                # ランダムに2人選んで入れ替え、スコアが良くなれば採用
-                for _ in range(optimize_steps):
-                    if current_cost == 0:
-                        break # 完璧なら終了
-
-                    # グループを2つ選ぶ（g1_idx != g2_idx）
-                    g1_idx, g2_idx = random.sample(range(effective_groups), 2)
-                    
-                    # それぞれのグループからメンバーを1人選ぶ
-                    # (空グループ対策: 万が一要素がない場合はスキップ)
-                    if not current_groups[g1_idx] or not current_groups[g2_idx]:
-                        continue
+        if mode == 'joint':
+            # 全日程をまとめて探索してから、日付順に履歴へ反映する
+            plans = self._optimize_schedule(auto_days, attempts, optimize_steps, time_budget)
+            for (day, day_participants, _), best_groups in zip(auto_days, plans):
+                # 反映前の履歴で計算すると、1日ずつ確定した場合と同じ意味のコストになる
+                min_cost = self._calculate_cost(best_groups)
+                schedule.append(self._finalize_day(day, day_participants, best_groups, min_cost, session_pair_history))
+        else:
+            for day, day_participants, effective_groups in auto_days:
+                # 履歴・学年・ペア制約をこの日の参加者の行列にまとめる（1日1回）
+                compiled = self._compile_day(day_participants)
+                best_groups, min_cost = self._optimize_day(compiled, effective_groups, attempts, optimize_steps)
+                schedule.append(self._finalize_day(day, day_participants, best_groups, min_cost, session_pair_history))
+
+        # 日付順にソートして返す
+        schedule.sort(key=lambda x: x['day'])
+        return schedule
+
+    def _finalize_day(self, day, day_participants, best_groups, min_cost, session_pair_history):
+        """確定した1日分のグループを履歴に反映し、スケジュールの1日分を作る"""
+        # 履歴更新（DB保存用・次回の計算用）
+        self._update_history(best_groups)
+        
+        # 詳細スコア計算
+        details = self.get_score_details(best_groups)
+
+        # --- 今回のリクエスト対応: セッション内のみの重複数を計算 ---
+        session_dupes = 0
+        for group in best_groups:
+            names = [p['name'] for p in group]
+            for p1, p2 in itertools.combinations(names, 2):
+                pair = self._get_pair_key(p1, p2)
+                if session_pair_history[pair] > 0:
+                    session_dupes += 1
+        
+        # セッション履歴も更新
+        for group in best_groups:
+            names = [p['name'] for p in group]
+            for p1, p2 in itertools.combinations(names, 2):
+                pair = self._get_pair_key(p1, p2)
+                session_pair_history[pair] += 1
+        
+        # detailsに追加
+        details['duplicate_count'] = session_dupes
+        details['absent_count'] = len(self.participants) - len(day_participants)
+
+        # 結果出力用に整形
+        display_groups = self._format_groups(best_groups)
+
+        return {
+            "day": day,
+            "groups": display_groups,
+            "cost": min_cost,
+            "details": details 
+        }
+
+    def _compile_day(self, day_participants, include_history=True):
+        """
+        この日の参加者について、ペアのコスト（過去の履歴・学年被り・avoid/prefer）を
+        密な行列 penalty[i][j] にまとめ、ハード制約を参加者インデックスの形に変換する
+        （改善ループ内のペア判定は行列を1回引くだけになる）
+        include_history=False のときは履歴を含めない（joint モードは履歴を別に数えるため）
+        """
+        n = len(day_participants)
+        names = [p['name'] for p in day_participants]
+        grades = [p['grade'] for p in day_participants]
+        index = {name: i for i, name in enumerate(names)}
+
+        penalty = [[0] * n for _ in range(n)]
+        lower_bound = 0
+        for i, j in itertools.combinations(range(n), 2):
+            pair_key = self._get_pair_key(names[i], names[j])
+            cost = 0
+            # .get を使う（defaultdict に未登録のペアを増やさないため）
+            hist_count = self.pair_history.get(pair_key, 0) if include_history else 0
+            if hist_count > 0:
+                cost += (hist_count ** 2) * self.WEIGHT_HISTORY
+            if grades[i] == grades[j]:
+                cost += self.WEIGHT_SAME_GRADE
+            cost += self.constraints.soft_penalty(pair_key, self.weights)
+            penalty[i][j] = penalty[j][i] = cost
+            # prefer があるとコストが負になりうるので、理論上の下限を覚えておく
+            if cost < 0:
+                lower_bound += cost
+
+        # must_separate: 参加者ごとに「同じグループにしてはいけない相手」の集合
+        # 行列にも大きなペナルティを入れておき、初期解に残った違反は探索で解消させる
+        separate = [set() for _ in range(n)]
+        for name1, name2 in self.constraints.separate:
+            if name1 in index and name2 in index:
+                i, j = index[name1], index[name2]
+                separate[i].add(j)
+                separate[j].add(i)
+                penalty[i][j] += SEPARATE_VIOLATION_PENALTY
+                penalty[j][i] += SEPARATE_VIOLATION_PENALTY
+
+        # must_together: つながっている人同士を1つのブロックにまとめる（Union-Find）
+        parent = list(range(n))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for name1, name2 in self.constraints.together:
+            if name1 in index and name2 in index:
+                parent[find(index[name1])] = find(index[name2])
+        members_by_root = defaultdict(list)
+        for i in range(n):
+            members_by_root[find(i)].append(i)
+        blocks = list(members_by_root.values())
+        block_of = [None] * n
+        for block in blocks:
+            for i in block:
+                block_of[i] = block
+
+        return {
+            'participants': day_participants,
+            'penalty': penalty,
+            'lower_bound': lower_bound,
+            'separate': separate,
+            'blocks': blocks,
+            'block_of': block_of,
+            'is_female': [str(p['gender']).upper() in ['女', 'F', 'FEMALE', 'WOMAN'] for p in day_participants],
+            'is_tool': [bool(p.get('is_tool')) for p in day_participants],
+        }
+
+    def _level_cost(self, female_count, tool_count, is_tool_sufficient):
+        """グループ単位のコスト（女性1人ぼっち・工具係の配分）"""
+        cost = 0
+        if female_count == 1:
+            cost += self.WEIGHT_SOLE_FEMALE
+        if is_tool_sufficient:
+            if tool_count == 0:
+                cost += self.WEIGHT_TOOL_SHORTAGE
+        else:
+            if tool_count >= 2:
+                cost += self.WEIGHT_TOOL_OVERCROWD
+        return cost
+
+    def _group_cost(self, members, compiled, is_tool_sufficient):
+        """1グループ分のコスト（_calculate_cost と同じ内容をインデックスで計算）"""
+        penalty = compiled['penalty']
+        cost = 0
+        for i, j in itertools.combinations(members, 2):
+            cost += penalty[i][j]
+
+        female_count = sum(1 for i in members if compiled['is_female'][i])
+        tool_count = sum(1 for i in members if compiled['is_tool'][i])
+        return cost + self._level_cost(female_count, tool_count, is_tool_sufficient)
+
+    def _initial_groups(self, compiled, num_groups):
+        """
+        ランダム初期解の生成
+        must_together のブロックは分けずに、空きがあって must_separate の相手がいないグループへ入れる
+        違反が残ったら並べ直してやり直し、最後まで残れば違反が最も少ない解を返す
+        （残った違反は行列のペナルティで探索中に解消させる）
+        """
+        best_groups = None
+        best_violations = None
+        for _ in range(INITIAL_RETRIES):
+            groups, violations = self._place_blocks(compiled, num_groups)
+            if best_violations is None or violations < best_violations:
+                best_groups, best_violations = groups, violations
+            if violations == 0:
+                break
+        return best_groups
+
+    def _place_blocks(self, compiled, num_groups):
+        """
+        ブロックを1回分ランダムに配置する（_initial_groups から呼ぶ）
+        戻り値: (グループ, must_separate の違反ペア数)
+        """
+        k, m = divmod(len(compiled['participants']), num_groups)
+        capacity = [k + 1 if i < m else k for i in range(num_groups)]
+        separate = compiled['separate']
+        block_of = compiled['block_of']
 
-                    p1_idx = random.randrange(len(current_groups[g1_idx]))
-                    p2_idx = random.randrange(len(current_groups[g2_idx]))
-
-                    # --- スワップ実行 ---
-                    # 一時的に入れ替えてみる
-                    p1 = current_groups[g1_idx][p1_idx]
-                    p2 = current_groups[g2_idx][p2_idx]
-                    
-                    current_groups[g1_idx][p1_idx] = p2
-                    current_groups[g2_idx][p2_idx] = p1
-
-                    # 新コスト計算
-                    # (全グループ計算しなおすと重いので、影響ある2グループだけ計算すれば高速だが、
-                    #  コードの単純化のため全体計算を行う。50人程度なら十分高速)
-                    new_cost = self._calculate_cost(current_groups)
-
-                    if new_cost < current_cost:
-                        # 改善したので採用（そのまま）
-                        current_cost = new_cost
-                    else:
-                        # 改悪または変化なしなので戻す（Revert）
-                        current_groups[g1_idx][p1_idx] = p1
-                        current_groups[g2_idx][p2_idx] = p2
-
-                # この試行の結果が、今までのベストなら記録
-                if current_cost < min_cost:
-                    min_cost = current_cost
-                    # 深いコピーをとっておく（参照渡し対策）
-                    best_groups = copy.deepcopy(current_groups)
-                
-                if min_cost == 0:
+        def conflicts(block, g):
+            return sum(1 for i in block for j in groups[g] if j in separate[i])
+
+        blocks = compiled['blocks'][:]
+        random.shuffle(blocks)
+        # 制約の厳しいブロック（大きい・must_separate の相手が多い）から先に入れる
+        blocks.sort(key=lambda b: (len(b), sum(len(separate[i]) for i in b)), reverse=True)
+
+        groups = [[] for _ in range(num_groups)]
+        order = list(range(num_groups))
+        for block in blocks:
+            # 同じ空きのグループ間では偏らないように順番を混ぜる
+            random.shuffle(order)
+            fits = [g for g in order if capacity[g] - len(groups[g]) >= len(block)]
+            if fits:
+                # 空きがあるグループのうち、違反が少なく空きが多い所
+                g = min(fits, key=lambda g: (conflicts(block, g), len(groups[g]) - capacity[g]))
+            else:
+                # ブロックがどこにも入りきらない場合だけ定員を超えて入れる（後で戻す）
+                g = min(order, key=lambda g: (conflicts(block, g), len(groups[g]) - capacity[g]))
+            groups[g].extend(block)
+
+        # 定員を超えたグループから1人ブロックの人を空きのあるグループへ移して人数を揃える
+        for g in range(num_groups):
+            while len(groups[g]) > capacity[g]:
+                targets = [h for h in order if len(groups[h]) < capacity[h]]
+                singles = [i for i in groups[g] if len(block_of[i]) == 1]
+                if not targets or not singles:
                     break
+                i, h = min(((i, h) for i in singles for h in targets),
+                           key=lambda move: sum(1 for j in groups[move[1]] if j in separate[move[0]]))
+                groups[g].remove(i)
+                groups[h].append(i)
 
-            # 履歴更新（DB保存用・次回の計算用）
-            self._update_history(best_groups)
-            
-            # 詳細スコア計算
-            details = self.get_score_details(best_groups)
-
-            # --- 今回のリクエスト対応: セッション内のみの重複数を計算 ---
-            session_dupes = 0
-            for group in best_groups:
-                names = [p['name'] for p in group]
-                for p1, p2 in itertools.combinations(names, 2):
-                    pair = self._get_pair_key(p1, p2)
-                    if session_pair_history[pair] > 0:
-                        session_dupes += 1
-            
-            # セッション履歴も更新
-            for group in best_groups:
-                names = [p['name'] for p in group]
-                for p1, p2 in itertools.combinations(names, 2):
-                    pair = self._get_pair_key(p1, p2)
-                    session_pair_history[pair] += 1
-            
-            # detailsに追加
-            details['duplicate_count'] = session_dupes
-            details['absent_count'] = len(self.participants) - len(day_participants)
-
-            # 結果出力用に整形
-            display_groups = self._format_groups(best_groups)
-
-            schedule.append({
-                "day": day,
-                "groups": display_groups,
-                "cost": min_cost,
-                "details": details 
+        violations = sum(1 for g in groups for i, j in itertools.combinations(g, 2) if j in separate[i])
+        return groups, violations
+
+    def _pick_swap(self, group1, group2, compiled, first=None):
+        """
+        2グループ間の入れ替え候補を作る（first を指定するとgroup1からはその人を動かす）
+        must_together のブロックは丸ごと動かし、人数が違うときは少ない側に1人ブロックを足して揃える
+        must_separate に反する候補は None を返す（コストで罰するのではなく候補から外す）
+        戻り値: (group1に残る人, group1から出る人, group2に残る人, group2から出る人)
+        """
+        block_of = compiled['block_of']
+        separate = compiled['separate']
+
+        out1 = list(block_of[first if first is not None else random.choice(group1)])
+        out2 = list(block_of[random.choice(group2)])
+        if len(out1) != len(out2):
+            small, group = (out1, group1) if len(out1) < len(out2) else (out2, group2)
+            singles = [i for i in group if len(block_of[i]) == 1 and i not in small]
+            need = abs(len(out1) - len(out2))
+            if len(singles) < need:
+                return None
+            small.extend(random.sample(singles, need))
+
+        stay1 = [i for i in group1 if i not in out1]
+        stay2 = [i for i in group2 if i not in out2]
+        if any(j in separate[i] for i in out1 for j in stay2):
+            return None
+        if any(j in separate[i] for i in out2 for j in stay1):
+            return None
+        return stay1, out1, stay2, out2
+
+    def _optimize_day(self, compiled, num_groups, attempts, optimize_steps, as_indices=False):
+        """
+        1日分のグループ分け（多点スタート + 山登り法）
+        戻り値: (参加者辞書のグループリスト, コスト)
+        as_indices=True のときはグループを参加者インデックスのリストで返す
+        """
+        is_tool_sufficient = (sum(compiled['is_tool']) >= num_groups)
+        lower_bound = compiled['lower_bound']
+
+        best_groups = None
+        min_cost = float('inf')
+
+        # --- 1. 多点スタート（局所解回避のため数回最初からやり直す） ---
+        for _ in range(attempts):
+            # A. ランダム初期解の生成
+            groups = self._initial_groups(compiled, num_groups)
+            group_costs = [self._group_cost(g, compiled, is_tool_sufficient) for g in groups]
+            current_cost = sum(group_costs)
+
+            # B. 山登り法（改善ループ）
+            # ランダムに入れ替え候補を作り、スコアが良くなれば採用
+            for _ in range(optimize_steps):
+                if current_cost <= lower_bound or num_groups < 2:
+                    break # 完璧なら終了
+
+                # グループを2つ選ぶ（g1_idx != g2_idx）
+                g1_idx, g2_idx = random.sample(range(num_groups), 2)
+                # (空グループ対策: 万が一要素がない場合はスキップ)
+                if not groups[g1_idx] or not groups[g2_idx]:
+                    continue
+
+                move = self._pick_swap(groups[g1_idx], groups[g2_idx], compiled)
+                if move is None:
+                    continue
+                stay1, out1, stay2, out2 = move
+                new_g1, new_g2 = stay1 + out2, stay2 + out1
+
+                # 影響のある2グループだけ計算しなおす
+                cost1 = self._group_cost(new_g1, compiled, is_tool_sufficient)
+                cost2 = self._group_cost(new_g2, compiled, is_tool_sufficient)
+                new_cost = current_cost - group_costs[g1_idx] - group_costs[g2_idx] + cost1 + cost2
+
+                if new_cost < current_cost:
+                    # 改善したので採用
+                    groups[g1_idx], groups[g2_idx] = new_g1, new_g2
+                    group_costs[g1_idx], group_costs[g2_idx] = cost1, cost2
+                    current_cost = new_cost
+
+            # この試行の結果が、今までのベストなら記録
+            if current_cost < min_cost:
+                min_cost = current_cost
+                best_groups = [g[:] for g in groups]
+
+            if min_cost <= lower_bound:
+                break
+
+        if as_indices:
+            return best_groups, min_cost
+        participants = compiled['participants']
+        return [[participants[i] for i in g] for g in best_groups], min_cost
+
+    def _optimize_schedule(self, auto_days, attempts, optimize_steps, time_budget=None):
+        """
+        自動で決める全日程をまとめて最適化する（joint モード）
+        ペアが k 回目に同じグループになるときのコストは (それまでの回数)² * WEIGHT_HISTORY なので、
+        合計は「どの日に一緒になったか」の順番に依存しない。そのため任意の日の入れ替えを
+        ペア回数の行列だけで差分計算でき、早い日が楽なペアを取ってしまう偏りを後から直せる。
+        A. 初期解: 1日ずつの方式を attempts の半分の試行で回す
+        B. 焼きなまし: 重複ペアを抱えた人について、同じ日の全員との入れ替えを差分評価して最良を選ぶ
+        time_budget があれば全体でその秒数を使い切るまで探索する。無ければ B の手数を
+        attempts * optimize_steps * 日数 / JOINT_MOVE_STEPS で決める（1日ずつの方式と同程度の計算量で、
+        乱数シードを固定すれば結果も再現できる）
+        auto_days: [(日, 参加者, グループ数), ...]
+        戻り値: 日ごとの参加者辞書のグループリスト（auto_days と同じ順）
+        """
+        # NaN / Infinity だと時間切れの判定が成り立たず探索が終わらない
+        if time_budget is not None and not math.isfinite(time_budget):
+            raise ValueError(f"time_budget が不正です: {time_budget}")
+        start = time.perf_counter()
+        W = self.WEIGHT_HISTORY
+        initial_attempts = max(1, (attempts + 1) // 2)
+
+        # 全日程を通した参加者インデックスと、ペアの回数行列（DB履歴 + 手動日程 + この探索の分）
+        names = sorted({p['name'] for _, day_participants, _ in auto_days for p in day_participants})
+        index = {name: i for i, name in enumerate(names)}
+        counts = [[0] * len(names) for _ in names]
+        for i, j in itertools.combinations(range(len(names)), 2):
+            counts[i][j] = counts[j][i] = self.pair_history.get(self._get_pair_key(names[i], names[j]), 0)
+
+        # 日ごとの状態: 学年・ペア制約は日ごとの行列、履歴は counts で数える
+        days = []
+        current_cost = 0
+        lower_bound = 0
+        for _, day_participants, num_groups in auto_days:
+            # 探索用の行列は履歴抜き（履歴は counts で数える）
+            compiled = self._compile_day(day_participants, include_history=False)
+            to_global = [index[p['name']] for p in day_participants]
+
+            # A. 初期解: その時点の回数を履歴として足した行列で、1日分を最適化する
+            initial = dict(compiled, penalty=[row[:] for row in compiled['penalty']])
+            penalty = initial['penalty']
+            for a, b in itertools.combinations(range(len(day_participants)), 2):
+                c = counts[to_global[a]][to_global[b]]
+                if c > 0:
+                    penalty[a][b] = penalty[b][a] = penalty[a][b] + (c ** 2) * W
+            # 時間切れなら改善なしのランダム初期解で済ませる
+            steps = optimize_steps
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                steps = 0
+            groups, _ = self._optimize_day(initial, num_groups, initial_attempts, steps, as_indices=True)
+
+            is_tool_sufficient = (sum(compiled['is_tool']) >= num_groups)
+            group_costs = [self._group_cost(g, compiled, is_tool_sufficient) for g in groups]
+            for g in groups:
+                for a, b in itertools.combinations(g, 2):
+                    i, j = to_global[a], to_global[b]
+                    current_cost += (counts[i][j] ** 2) * W
+                    counts[i][j] += 1
+                    counts[j][i] += 1
+            current_cost += sum(group_costs)
+            lower_bound += compiled['lower_bound']
+            days.append({
+                'compiled': compiled,
+                'groups': groups,
+                'group_costs': group_costs,
+                'to_global': to_global,
+                'is_tool_sufficient': is_tool_sufficient,
+                # 参加者インデックス → 所属グループ
+                'group_of': [gi for _, gi in sorted((x, gi) for gi, g in enumerate(groups) for x in g)],
             })
 
-        # 日付順にソートして返す
-        schedule.sort(key=lambda x: x['day'])
-        return schedule
+        # 探索の長さ: time_budget があれば残り時間、無ければ手数で決める
+        search_start = time.perf_counter()
+        if time_budget is None:
+            search_time = None
+            max_moves = attempts * optimize_steps * len(auto_days) // JOINT_MOVE_STEPS
+        else:
+            search_time = max(time_budget - (search_start - start), 0)
+            max_moves = None
+
+        best_cost = current_cost
+        best_groups = [[g[:] for g in d['groups']] for d in days]
+        # 今の状態がベストだがまだコピーしていない（悪化を受け入れる直前にだけコピーする）
+        best_pending = False
+
+        # B. 焼きなまし: 入れ替えができる日（グループが2つ以上）から1日選んで入れ替える
+        movable = [d for d in days if len(d['groups']) >= 2]
+        # 初期温度: 2回目の重複1組分の半分程度の悪化なら序盤は受け入れる
+        initial_temp = W * 0.4
+        temp = initial_temp
+
+        for step in itertools.count():
+            if not movable or current_cost <= lower_bound:
+                break
+
+            # 進み具合（手数 or 経過時間）に合わせて温度を下げる
+            if max_moves is not None:
+                if step >= max_moves:
+                    break
+                temp = initial_temp * (1 - step / max_moves)
+            elif step % 16 == 0:
+                # 時刻の確認は間引く
+                elapsed = time.perf_counter() - search_start
+                if elapsed >= search_time:
+                    break
+                temp = initial_temp * (1 - elapsed / search_time)
+
+            d = random.choice(movable)
+            groups = d['groups']
+            group_of = d['group_of']
+            to_global = d['to_global']
+            compiled = d['compiled']
+
+            # 動かす人を選ぶ: 同じグループに重複ペアの相手がいる人を優先する（数回だけ探す）
+            for _ in range(CONFLICT_TRIES):
+                x = random.randrange(len(group_of))
+                row = counts[to_global[x]]
+                if any(row[to_global[y]] >= 2 for y in groups[group_of[x]] if y != x):
+                    break
+
+            g1_idx = group_of[x]
+            if len(compiled['block_of'][x]) == 1:
+                # 1人ブロックなら、他のグループの1人ブロック全員との入れ替えを比べて最良を選ぶ
+                move = self._best_swap(x, d, counts)
+                if move is None:
+                    continue
+                g2_idx, y = move
+                stay1 = [i for i in groups[g1_idx] if i != x]
+                stay2 = [i for i in groups[g2_idx] if i != y]
+                out1, out2 = [x], [y]
+            else:
+                # must_together のブロックはランダムな相手グループとブロックごと入れ替える
+                g2_idx = random.randrange(len(groups) - 1)
+                if g2_idx >= g1_idx:
+                    g2_idx += 1
+                if not groups[g2_idx]:
+                    continue
+                move = self._pick_swap(groups[g1_idx], groups[g2_idx], compiled, first=x)
+                if move is None:
+                    continue
+                stay1, out1, stay2, out2 = move
+            new_g1, new_g2 = stay1 + out2, stay2 + out1
+
+            cost1 = self._group_cost(new_g1, compiled, d['is_tool_sufficient'])
+            cost2 = self._group_cost(new_g2, compiled, d['is_tool_sufficient'])
+            delta = cost1 + cost2 - d['group_costs'][g1_idx] - d['group_costs'][g2_idx]
+
+            # 履歴の差分: 離れるペアは最後の1回分を引き、新しく組むペアは次の1回分を足す
+            # （1回の入れ替えで同じペアが離れて組み直すことはないので、現在の回数で計算できる）
+            for moving, left, joined in ((out1, stay1, stay2), (out2, stay2, stay1)):
+                for i in moving:
+                    row = counts[to_global[i]]
+                    for j in left:
+                        c = row[to_global[j]] - 1
+                        delta -= c * c * W
+                    for j in joined:
+                        c = row[to_global[j]]
+                        delta += c * c * W
+
+            if delta > 0:
+                if temp <= 0 or random.random() >= math.exp(-delta / temp):
+                    continue
+                if best_pending:
+                    best_groups = [[g[:] for g in day['groups']] for day in days]
+                    best_pending = False
+
+            # 採用: 回数行列とグループを更新
+            for moving, left, joined in ((out1, stay1, stay2), (out2, stay2, stay1)):
+                for i in moving:
+                    gi = to_global[i]
+                    for j in left:
+                        gj = to_global[j]
+                        counts[gi][gj] -= 1
+                        counts[gj][gi] -= 1
+                    for j in joined:
+                        gj = to_global[j]
+                        counts[gi][gj] += 1
+                        counts[gj][gi] += 1
+            groups[g1_idx], groups[g2_idx] = new_g1, new_g2
+            for i in out1:
+                group_of[i] = g2_idx
+            for i in out2:
+                group_of[i] = g1_idx
+            d['group_costs'][g1_idx], d['group_costs'][g2_idx] = cost1, cost2
+            current_cost += delta
+
+            if current_cost < best_cost:
+                best_cost = current_cost
+                best_pending = True
+
+        if best_pending:
+            best_groups = [[g[:] for g in d['groups']] for d in days]
+
+        plans = []
+        for d, groups in zip(days, best_groups):
+            participants = d['compiled']['participants']
+            plans.append([[participants[i] for i in g] for g in groups])
+        return plans
+
+    def _best_swap(self, x, day, counts):
+        """
+        joint モード用: 1人ブロックの x と、他のグループの1人ブロック y との入れ替えを全て差分評価し、
+        コストが最も下がる (y のグループ, y) を返す（同点はランダム、must_separate に反する相手は除く）
+        """
+        compiled = day['compiled']
+        groups = day['groups']
+        to_global = day['to_global']
+        suff = day['is_tool_sufficient']
+        penalty = compiled['penalty']
+        separate = compiled['separate']
+        block_of = compiled['block_of']
+        is_female = compiled['is_female']
+        is_tool = compiled['is_tool']
+        W = self.WEIGHT_HISTORY
+
+        g1_idx = day['group_of'][x]
+        rest1 = [i for i in groups[g1_idx] if i != x]
+        rest1_global = [to_global[i] for i in rest1]
+        row_x = counts[to_global[x]]
+        pen_x = penalty[x]
+        # x が抜けることで減るコスト
+        x_out = sum(pen_x[i] for i in rest1) + W * sum((row_x[t] - 1) ** 2 for t in rest1_global)
+        female1 = sum(is_female[i] for i in rest1)
+        tool1 = sum(is_tool[i] for i in rest1)
+        level1 = self._level_cost(female1 + is_female[x], tool1 + is_tool[x], suff)
+
+        best = None
+        best_delta = None
+        ties = 0
+        for g2_idx, group2 in enumerate(groups):
+            if g2_idx == g1_idx or not group2:
+                continue
+            if any(j in separate[x] for j in group2):
+                # x が入れない相手がいるグループは、その人と入れ替える場合だけ候補になる
+                blocked = [j for j in group2 if j in separate[x]]
+                if len(blocked) > 1:
+                    continue
+                candidates = blocked
+            else:
+                candidates = group2
+            female2 = sum(is_female[i] for i in group2)
+            tool2 = sum(is_tool[i] for i in group2)
+            level2 = self._level_cost(female2, tool2, suff)
+            for y in candidates:
+                if len(block_of[y]) != 1 or any(j in separate[y] for j in rest1):
+                    continue
+                row_y = counts[to_global[y]]
+                pen_y = penalty[y]
+                delta = sum(pen_y[i] for i in rest1) + W * sum(row_y[t] ** 2 for t in rest1_global) - x_out
+                for i in group2:
+                    if i == y:
+                        continue
+                    t = to_global[i]
+                    delta += pen_x[i] + W * row_x[t] ** 2 - pen_y[i] - W * (row_y[t] - 1) ** 2
+                delta += self._level_cost(female1 + is_female[y], tool1 + is_tool[y], suff) - level1
+                delta += self._level_cost(female2 - is_female[y] + is_female[x],
+                                          tool2 - is_tool[y] + is_tool[x], suff) - level2
+                if best_delta is None or delta < best_delta:
+                    best, best_delta, ties = (g2_idx, y), delta, 1
+                elif delta == best_delta:
+                    # 同点の候補からは等確率で選ぶ
+                    ties += 1
+                    if random.randrange(ties) == 0:
+                        best = (g2_idx, y)
+        return best
 
     def _format_groups(self, groups):
         """グループを学年降順でソートして表示用に整形する（M2 > M1 > 4 > 3 > 2 > 1）"""
@@ -364,4 +1022,34 @@ class GroupOptimizer:
                 {'name': p['name'], 'grade': p['grade'], 'gender': p['gender'], 'is_tool': p.get('is_tool', False)}
                 for p in g_sorted
             ])
-        return display_groups
\ No newline at end of file
+        return display_groups
+
+
+def optimize_cohort(participants, num_groups, num_days, history=None, couples=None,
+                    pair_rules=None, fixed_days=None, weights=None, attempts=10, optimize_steps=2000,
+                    mode='sequential', time_budget=None):
+    """
+    1コホート（名簿1つ分）のグループ分けを実行してスケジュールを返す
+    Flaskのフォーム・バッチAPI（ワーカープロセス）・CLIの共通入口
+    history: DBから読み込んだ {(名前1, 名前2): 回数} の辞書
+    couples: [{'name1': ..., 'name2': ...}, ...] 同じグループにしないペア（must_separate として扱う）
+    pair_rules: PairConstraints.from_rules に渡すペア制約のリスト
+    mode / time_budget: GroupOptimizer.make_groups を参照
+    """
+    constraints = PairConstraints.from_rules(pair_rules or [])
+    for couple in couples or []:
+        name1 = couple.get('name1', '')
+        name2 = couple.get('name2', '')
+        # 空欄や同じ名前同士の入力ミスは無視する（フォームからそのまま来るため）
+        if name1 and name2 and name1 != name2:
+            constraints.add(PairConstraints.MUST_SEPARATE, name1, name2)
+
+    optimizer = GroupOptimizer(participants, weights=weights, constraints=constraints)
+
+    # 履歴データの復元
+    for pair, count in (history or {}).items():
+        optimizer.pair_history[pair] = count
+
+    return optimizer.make_groups(num_groups, num_days, attempts=attempts,
+                                 fixed_days=fixed_days, optimize_steps=optimize_steps,
+                                 mode=mode, time_budget=time_budget)